@@ -1,14 +1,33 @@
 import os
+import re
 import json
+import hashlib
+import pickle
 import streamlit as st
 from dotenv import load_dotenv
+import aiohttp
+from azure.core import MatchConditions
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+from azure.storage.blob.aio import BlobServiceClient as AioBlobServiceClient
 from datetime import datetime, timedelta
 from openai import AzureOpenAI
+import numpy as np
 import pandas as pd
+import tiktoken
 from docx import Document
 from io import BytesIO
 import io
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # Respaldo con la librería estándar
+    json_loads = json.loads
 
 # === Configuración inicial ===
 st.set_page_config(page_title="Analista Documental - Mejoramiento de Vivienda", layout="wide")
@@ -21,10 +40,9 @@ AZURE_OPENAI_KEY = os.getenv("OPENAI_API_KEY_AZURE")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_ENDPOINT")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_GPT_DEPLOYMENT")
 AZURE_OPENAI_API_VERSION = os.getenv("OPENAI_API_VERSION")
+AZURE_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-3-small")
 
 # === Inicialización de sesión ===
-if 'documentos_contexto' not in st.session_state:
-    st.session_state.documentos_contexto = ""
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 
@@ -64,57 +82,402 @@ Usa la nemotecnia y reglas ubicadas en 'DOCUMENTOS_GENERALES_PROYECTO_DE_BUENAVE
 """
 
 # === Generar URL SAS ===
-def generar_url_sas(blob_name):
+def _expiracion_diaria(dia):
+    # Vencimiento redondeado al inicio del día UTC: la firma es la misma durante todo el día
+    return datetime(dia.year, dia.month, dia.day) + timedelta(days=90)
+
+@st.cache_data(ttl=86400, max_entries=8192)  # Las claves de días anteriores caducan solas
+def _firmar_url_sas(blob_name, dia):
     sas_token = generate_blob_sas(
         account_name=blob_service_client.account_name,
         container_name=AZURE_CONTAINER_NAME,
         blob_name=blob_name,
         account_key=blob_service_client.credential.account_key,
         permission=BlobSasPermissions(read=True),
-        expiry=datetime.utcnow() + timedelta(days=90)
+        expiry=_expiracion_diaria(dia)
     )
     return f"https://{blob_service_client.account_name}.blob.core.windows.net/{AZURE_CONTAINER_NAME}/{blob_name}?{sas_token}"
 
+def generar_url_sas(blob_name):
+    return _firmar_url_sas(blob_name, datetime.utcnow().date())
+
 # === Leer archivos del contenedor ===
-@st.cache_data(ttl=3600)  # Cache por 1 hora
-def leer_archivos_texto():
-    contenido_total = ""
+MAX_DESCARGAS_PARALELAS = 32
+MAX_CONEXIONES_BLOB = 64  # Pool del cliente asíncrono; cubre las descargas por rangos de blobs grandes
+# Tamaño máximo de la primera GET del cliente asíncrono (el SDK usa 32 MiB por defecto);
+# lo que exceda se descarga en rangos paralelos de hasta DESCARGAS_POR_BLOB peticiones
+UMBRAL_BLOB_GRANDE = 4 * 1024 * 1024
+DESCARGAS_POR_BLOB = 8
+RESULTADOS_POR_PAGINA = 5000
+# Prefijos (separados por comas) donde viven los documentos de contexto; vacío = todo el contenedor
+PREFIJOS_CONTEXTO = [p.strip() for p in os.getenv("AZURE_BLOB_PREFIXES", "").split(",") if p.strip()] or [""]
+
+def _tipo_blob(nombre):
+    if nombre.endswith(".txt") or nombre.endswith(".md"):
+        return "texto"
+    if nombre.endswith(".docx") and "DOCUMENTOS_GENERALES" in nombre:
+        return "docx"
+    if nombre.endswith(".xlsx") and "Estado_documental_postulados" in nombre:
+        return "xlsx"
+    return None
+
+@st.cache_resource
+def _fragmentos_por_blob():
+    # (versión, nombre, etag) -> fragmento ya procesado; compartido por todas las sesiones.
+    # La versión del formato va en la clave porque esta caché sobrevive a recargas del código.
+    return {}
+
+def _listar_prefijo(prefijo):
+    paginas = container_client.list_blobs(name_starts_with=prefijo or None, results_per_page=RESULTADOS_POR_PAGINA)
+    return [(blob.name, blob.etag) for blob in paginas]
+
+def listar_blobs_contexto():
+    # Un listado por prefijo, en paralelo; los prefijos pueden solaparse.
+    # Solo se conservan los blobs que forman parte del contexto: (nombre, etag, tipo)
+    with ThreadPoolExecutor(max_workers=len(PREFIJOS_CONTEXTO)) as executor:
+        listados = list(executor.map(_listar_prefijo, PREFIJOS_CONTEXTO))
+    blobs = {}
+    for listado in listados:
+        for nombre, etag in listado:
+            tipo = _tipo_blob(nombre)
+            if tipo and nombre not in blobs:
+                blobs[nombre] = (nombre, etag, tipo)
+    return tuple(blobs.values())
+
+async def _descargar_blobs(blobs):
+    # Cliente asíncrono propio: todas las descargas comparten un único event loop y
+    # un pool de conexiones del tamaño de la concurrencia, que reutiliza las conexiones TLS
+    conector = aiohttp.TCPConnector(limit=MAX_CONEXIONES_BLOB)
+    async with aiohttp.ClientSession(connector=conector) as sesion:
+        transporte = AioHttpTransport(session=sesion, session_owner=False)
+        async with AioBlobServiceClient.from_connection_string(
+            AZURE_CONNECTION_STRING, transport=transporte, max_single_get_size=UMBRAL_BLOB_GRANDE
+        ) as servicio:
+            contenedor = servicio.get_container_client(AZURE_CONTAINER_NAME)
+            limite = asyncio.Semaphore(MAX_DESCARGAS_PARALELAS)
+
+            async def descargar(nombre, etag):
+                async with limite:
+                    # Se exige el ETag del listado: si el blob cambió entretanto la descarga falla
+                    # en vez de guardar contenido nuevo bajo la huella vieja
+                    descarga = await contenedor.download_blob(
+                        nombre,
+                        etag=etag,
+                        match_condition=MatchConditions.IfNotModified,
+                        max_concurrency=DESCARGAS_POR_BLOB,
+                    )
+                    return await descarga.readall()
+
+            return await asyncio.gather(*(descargar(nombre, etag) for nombre, etag, _ in blobs))
+
+def _procesar_blob(nombre, tipo, data):
+    if tipo == "texto":
+        texto = data.decode("utf-8", errors="ignore")
+        return f"\n---\nArchivo: {nombre}\n{texto}\n"
+    if tipo == "docx":
+        doc = Document(io.BytesIO(data))
+        texto = "\n".join(p.text for p in doc.paragraphs)
+        return f"\n---\nArchivo: {nombre}\n{texto}\n"
+    # dtype=str evita la inferencia de tipos: solo se usa la representación en texto
+    df = pd.read_excel(BytesIO(data), engine="openpyxl", dtype=str)
+    # CSV en lugar de una tabla alineada con espacios: mismo contenido con muchos menos tokens
+    return f"\n---\nResumen documental:\n{df.to_csv(index=False)}\n"
+
+def leer_archivos_texto(blobs):
+    cache = _fragmentos_por_blob()
+    previos = dict(cache)
+    # Solo se descargan los blobs nuevos o modificados desde la última lectura
+    pendientes = [blob for blob in blobs if (VERSION_CONTEXTO, *blob[:2]) not in previos]
+    datos = asyncio.run(_descargar_blobs(pendientes))
+    nuevos = {}
+    for (nombre, etag, tipo), data in zip(pendientes, datos):
+        # Un archivo corrupto no tumba el contexto: queda vacío hasta que cambie su ETag
+        try:
+            nuevos[(VERSION_CONTEXTO, nombre, etag)] = _procesar_blob(nombre, tipo, data)
+        except Exception as e:
+            st.warning(f"No se pudo procesar {nombre}: {e}")
+            nuevos[(VERSION_CONTEXTO, nombre, etag)] = ""
+    vigentes = {(VERSION_CONTEXTO, nombre, etag) for nombre, etag, _ in blobs}
+    cache.update(nuevos)
+    for clave in list(cache):
+        if clave not in vigentes:
+            cache.pop(clave, None)
+    fragmentos = {**previos, **nuevos}
+    # Se arma en el orden del listado, así el contexto final es estable
+    return "".join(fragmentos[(VERSION_CONTEXTO, nombre, etag)] for nombre, etag, _ in blobs)
+
+# === Caché del contexto según la huella del contenedor ===
+CONTEXTO_CACHE_PATH = ".ctx.pkl"
+VERSION_CONTEXTO = "2"  # Cambiarla cuando cambie el formato del contexto invalida .ctx.pkl
+ESPERA_TRAS_FALLO_CONTEXTO = 300  # Segundos sin reintentar la descarga después de un fallo
+
+@st.cache_data(ttl=3600)  # Revisa cambios en el contenedor como máximo cada hora
+def listado_contenedor():
+    # Solo metadatos: el contenido se vuelve a descargar únicamente si cambia algún ETag.
+    # Se usa sha256 (y no hash()) para que la huella sea estable entre reinicios.
+    # La huella y la carga usan el mismo listado, así nunca pueden discrepar.
+    blobs = listar_blobs_contexto()
+    h = hashlib.sha256(VERSION_CONTEXTO.encode("utf-8"))
+    for nombre, etag, _ in blobs:
+        h.update(f"{nombre}\0{etag}\n".encode("utf-8"))
+    return h.hexdigest(), blobs
+
+def _leer_contexto_guardado():
+    try:
+        with open(CONTEXTO_CACHE_PATH, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None, ""
+
+def _guardar_contexto(huella, contenido):
+    temporal = f"{CONTEXTO_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(temporal, "wb") as f:
+        pickle.dump((huella, contenido), f)
+    os.replace(temporal, CONTEXTO_CACHE_PATH)
+
+@st.cache_resource(max_entries=2)  # Solo el contexto vigente (y el anterior) ocupan memoria
+def cargar_contexto(huella, _blobs):
+    # `_blobs` no entra en la clave de caché: lo determina la huella
+    huella_guardada, contenido_guardado = _leer_contexto_guardado()
+    if huella_guardada == huella:
+        return contenido_guardado
+    # Los errores se propagan a propósito: Streamlit no guarda excepciones en la caché,
+    # así un fallo transitorio no queda fijado para esta huella
+    contenido = leer_archivos_texto(_blobs)
+    _guardar_contexto(huella, contenido)
+    return contenido
+
+def obtener_listado():
+    try:
+        return listado_contenedor()
+    except Exception as e:
+        st.error(f"Error al leer archivos del contenedor: {e}")
+        return None
+
+@st.cache_resource
+def _fallos_contexto():
+    # huella -> momento del último fallo al cargar su contexto
+    return {}
+
+# Devuelve None si la carga falla; tras un fallo no se reintenta durante un tiempo,
+# así un error persistente no provoca una descarga completa en cada rerun
+def _intentar_cargar_contexto(listado):
+    huella = listado[0]
+    fallos = _fallos_contexto()
+    if huella in fallos and time.monotonic() - fallos[huella] < ESPERA_TRAS_FALLO_CONTEXTO:
+        return None
     try:
-        for blob in container_client.list_blobs():
-            if blob.name.endswith(".txt") or blob.name.endswith(".md"):
-                data = container_client.download_blob(blob.name).readall().decode("utf-8", errors="ignore")
-                contenido_total += f"\n---\nArchivo: {blob.name}\n{data}\n"
-            elif blob.name.endswith(".docx") and "DOCUMENTOS_GENERALES" in blob.name:
-                doc_bytes = container_client.download_blob(blob.name).readall()
-                doc = Document(io.BytesIO(doc_bytes))
-                texto = "\n".join([p.text for p in doc.paragraphs])
-                contenido_total += f"\n---\nArchivo: {blob.name}\n{texto}\n"
-            elif blob.name.endswith(".xlsx") and "Estado_documental_postulados" in blob.name:
-                df_bytes = container_client.download_blob(blob.name).readall()
-                with open("temp_excel.xlsx", "wb") as f:
-                    f.write(df_bytes)
-                df = pd.read_excel("temp_excel.xlsx")
-                contenido_total += f"\n---\nResumen documental:\n{df.to_string(index=False)}\n"
-                os.remove("temp_excel.xlsx")
+        contenido = cargar_contexto(*listado)
     except Exception as e:
+        fallos[huella] = time.monotonic()
         st.error(f"Error al leer archivos del contenedor: {e}")
-    return contenido_total
+        listado_contenedor.clear()  # El próximo intento parte de un listado nuevo
+        return None
+    fallos.pop(huella, None)
+    return contenido
+
+def obtener_contexto(listado):
+    contenido = _intentar_cargar_contexto(listado) if listado is not None else None
+    if contenido is None:
+        # Sin acceso al contenedor se sirve el último contexto guardado en disco
+        return _leer_contexto_guardado()[1]
+    return contenido
+
+# === Recuperación de fragmentos relevantes ===
+TAMANO_FRAGMENTO = 3200  # Caracteres, ~800 tokens
+FRAGMENTOS_POR_CONSULTA = 5
+FRAGMENTOS_POR_CEDULA = 3  # Fragmentos con coincidencia literal que se añaden por cada cédula
+MAX_ENTRADAS_LOTE = 2048  # Límite de entradas por petición de embeddings
+MAX_TOKENS_LOTE = 100_000  # Muy por debajo del tope de tokens por petición
+MAX_LOTES_PARALELOS = 4
+# Cuota de tokens por minuto del despliegue de embeddings; el envío de lotes se ajusta a ella
+EMBEDDING_TPM = int(os.getenv("AZURE_EMBEDDING_TPM", "350000"))
+ESPERA_TRAS_FALLO_INDICE = 300  # Segundos sin reintentar el índice después de un fallo
+
+# Separadores que escribe _procesar_blob; un "---" suelto dentro de un Markdown no cuenta
+SEPARADOR_DOCUMENTO = re.compile(r"\n---\n(?=Archivo: |Resumen documental:\n)")
+
+def _lineas_acotadas(texto):
+    # Las líneas más largas que un fragmento se parten; el resto se respeta entero
+    for linea in texto.split("\n"):
+        for inicio in range(0, max(len(linea), 1), TAMANO_FRAGMENTO):
+            yield linea[inicio:inicio + TAMANO_FRAGMENTO]
+
+def dividir_en_fragmentos(contenido):
+    fragmentos = []
+    for documento in SEPARADOR_DOCUMENTO.split(contenido):
+        documento = documento.strip("\n")
+        if not documento:
+            continue
+        # Cada fragmento conserva el encabezado ("Archivo: ...") de su documento;
+        # en la tabla del estado documental también repite la fila de columnas
+        encabezado, _, cuerpo = documento.partition("\n")
+        if encabezado == "Resumen documental:":
+            columnas, _, cuerpo = cuerpo.partition("\n")
+            encabezado = f"{encabezado}\n{columnas}"
+        lineas, tamano = [], 0
+        for linea in _lineas_acotadas(cuerpo):
+            if lineas and tamano + len(linea) + 1 > TAMANO_FRAGMENTO:
+                fragmentos.append(encabezado + "\n" + "\n".join(lineas))
+                lineas, tamano = [], 0
+            lineas.append(linea)
+            tamano += len(linea) + 1
+        if lineas:
+            fragmentos.append(encabezado + "\n" + "\n".join(lineas))
+    return fragmentos
+
+@st.cache_resource
+def get_tokenizer_embeddings():
+    return tiktoken.get_encoding("cl100k_base")
+
+def _lotes_por_tokens(fragmentos):
+    enc = get_tokenizer_embeddings()
+    lotes = []
+    lote, tokens_lote = [], 0
+    for fragmento in fragmentos:
+        tokens = len(enc.encode(fragmento))
+        if lote and (tokens_lote + tokens > MAX_TOKENS_LOTE or len(lote) >= MAX_ENTRADAS_LOTE):
+            lotes.append((lote, tokens_lote))
+            lote, tokens_lote = [], 0
+        lote.append(fragmento)
+        tokens_lote += tokens
+    if lote:
+        lotes.append((lote, tokens_lote))
+    return lotes
+
+def _embeddings_lote(lote):
+    # El cliente reintenta los 429 con espera, respetando `retry-after`
+    return client.with_options(max_retries=5).embeddings.create(model=AZURE_EMBEDDING_DEPLOYMENT, input=lote)
+
+@st.cache_resource
+def _fallos_indice():
+    # huella -> momento del último fallo al construir su índice
+    return {}
+
+# Si la carga del contexto falla, la excepción atraviesa esta función y no se guarda un índice vacío
+@st.cache_resource(max_entries=2)
+def cargar_indice_fragmentos(huella, _blobs):
+    fragmentos = dividir_en_fragmentos(cargar_contexto(huella, _blobs))
+    if not fragmentos:
+        return fragmentos, None
+    futuros = []
+    enviados = deque()  # (momento, tokens) de los lotes enviados en el último minuto
+    with ThreadPoolExecutor(max_workers=MAX_LOTES_PARALELOS) as executor:
+        for lote, tokens in _lotes_por_tokens(fragmentos):
+            # Antes de enviar un lote se espera a que quepa en la cuota del último minuto
+            while enviados and sum(t for _, t in enviados) + tokens > EMBEDDING_TPM:
+                antiguedad = time.monotonic() - enviados[0][0]
+                if antiguedad >= 60:
+                    enviados.popleft()
+                else:
+                    time.sleep(60 - antiguedad)
+            enviados.append((time.monotonic(), tokens))
+            futuros.append(executor.submit(_embeddings_lote, lote))
+        respuestas = [futuro.result() for futuro in futuros]
+    matriz = np.array([e.embedding for r in respuestas for e in r.data], dtype=np.float32)
+    matriz /= np.linalg.norm(matriz, axis=1, keepdims=True)
+    return fragmentos, matriz
+
+def _fragmentos_con_cedulas(fragmentos, consulta):
+    # Los embeddings no distinguen bien números exactos: los fragmentos que contienen
+    # literalmente una cédula de la consulta se envían siempre, primero los de la tabla
+    # del estado documental
+    elegidos = []
+    for cedula in dict.fromkeys(CEDULA_RE.findall(consulta)):
+        patron = re.compile(rf"(?<!\d){cedula}(?!\d)")
+        coincidencias = [i for i, fragmento in enumerate(fragmentos) if patron.search(fragmento)]
+        coincidencias.sort(key=lambda i: not fragmentos[i].startswith("Resumen documental:"))
+        elegidos.extend(coincidencias[:FRAGMENTOS_POR_CEDULA])
+    return list(dict.fromkeys(elegidos))
+
+# Devuelve None cuando no hay índice disponible y debe usarse el contexto completo
+def recuperar_fragmentos(consulta, listado):
+    # Si el contexto no se puede cargar (o está en espera tras un fallo) no hay índice que construir
+    if listado is None or _intentar_cargar_contexto(listado) is None:
+        return None
+    huella = listado[0]
+    # Tras un fallo (p. ej. un 429) no se reintenta todo el corpus en cada pregunta
+    fallos = _fallos_indice()
+    if huella in fallos and time.monotonic() - fallos[huella] < ESPERA_TRAS_FALLO_INDICE:
+        return None
+    try:
+        fragmentos, matriz = cargar_indice_fragmentos(*listado)
+    except Exception as e:
+        fallos[huella] = time.monotonic()
+        st.warning(f"No se pudo usar la búsqueda por similitud, se envía el contexto completo: {e}")
+        return None
+    fallos.pop(huella, None)
+    if matriz is None:
+        return ""
+    try:
+        respuesta = client.embeddings.create(model=AZURE_EMBEDDING_DEPLOYMENT, input=[consulta])
+        vector = np.array(respuesta.data[0].embedding, dtype=np.float32)
+    except Exception as e:
+        st.warning(f"No se pudo usar la búsqueda por similitud, se envía el contexto completo: {e}")
+        return None
+    similitudes = matriz @ vector / np.linalg.norm(vector)
+    k = min(FRAGMENTOS_POR_CONSULTA, len(fragmentos))
+    mejores = np.argpartition(-similitudes, k - 1)[:k]
+    mejores = mejores[np.argsort(-similitudes[mejores])]
+    elegidos = dict.fromkeys(_fragmentos_con_cedulas(fragmentos, consulta))
+    elegidos.update(dict.fromkeys(int(i) for i in mejores))
+    return "".join(f"\n---\n{fragmentos[i]}\n" for i in elegidos)
 
 # === Detectar imágenes asociadas a cédula ===
+CEDULA_RE = re.compile(r"\b\d{6,}\b")
+
+# cache_resource y no cache_data: el dict se comparte sin copiarlo, en lugar de
+# deserializar todo el índice en cada consulta. Es de solo lectura.
+@st.cache_resource(ttl=3600)  # Cache por 1 hora
+def cargar_indice_cedulas(municipio):
+    blob_name = f"{municipio}/urls_imagenes.json"
+    blob_data = container_client.download_blob(blob_name).readall()
+    return json_loads(blob_data)
+
 def encontrar_imagenes_por_cedula(cedula, municipio="6-Buenaventura-2025"):
     try:
-        blob_name = f"{municipio}/urls_imagenes.json"
-        blob_data = container_client.download_blob(blob_name).readall()
-        index = json.loads(blob_data.decode("utf-8"))
-        return index.get(cedula, [])
+        return cargar_indice_cedulas(municipio).get(cedula, [])
     except Exception as e:
         st.error(f"Error al leer índice de imágenes: {e}")
         return []
 
 # === Cargar documentos al inicio ===
-if not st.session_state.documentos_contexto:
-    with st.spinner("Cargando documentos de contexto..."):
-        st.session_state.documentos_contexto = leer_archivos_texto()
+# El contexto vive en la caché del proceso (compartida entre sesiones); aquí solo se precalienta.
+with st.spinner("Cargando documentos de contexto..."):
+    obtener_contexto(obtener_listado())
+
+# === Historial enviado al modelo ===
+MAX_TOKENS_HISTORIAL = 4000
+
+@st.cache_resource
+def get_tokenizer():
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def historial_reciente(historial, max_tokens=MAX_TOKENS_HISTORIAL):
+    # Recorre desde el mensaje más reciente hasta agotar el presupuesto de tokens;
+    # el último mensaje (la pregunta actual) siempre se incluye.
+    enc = get_tokenizer()
+    mensajes = []
+    total = 0
+    for mensaje in reversed(historial):
+        if "tokens" not in mensaje:
+            mensaje["tokens"] = len(enc.encode(mensaje["content"]))
+        total += mensaje["tokens"]
+        if total > max_tokens and mensajes:
+            break
+        mensajes.append({"role": mensaje["role"], "content": mensaje["content"]})
+    mensajes.reverse()
+    return mensajes
+
+# === Texto incremental de la respuesta ===
+def texto_respuesta(stream):
+    # Azure puede enviar fragmentos sin `choices` (p. ej. resultados del filtro de contenido)
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
 
 # === Interfaz de usuario ===
 st.title("💬 Analista Documental - Mejoramiento de Vivienda")
@@ -128,8 +491,13 @@ with st.sidebar:
     st.header("Configuración")
     st.info("Conectado a Azure Blob Storage y OpenAI")
     if st.button("Actualizar documentos de contexto"):
+        listado_contenedor.clear()
+        cargar_contexto.clear()
+        cargar_indice_fragmentos.clear()
+        _fallos_indice().clear()
+        _fallos_contexto().clear()
         with st.spinner("Actualizando documentos..."):
-            st.session_state.documentos_contexto = leer_archivos_texto()
+            obtener_contexto(obtener_listado())
         st.success("Documentos actualizados!")
 
 # Historial de chat
@@ -150,36 +518,59 @@ if prompt := st.chat_input("Escribe tu pregunta..."):
     
     # Procesar pregunta
     with st.spinner("Buscando información..."):
-        # Extraer cédulas de la pregunta
-        cedulas_en_pregunta = [s for s in prompt.split() if s.isdigit() and len(s) >= 6]
-        urls_imagenes = []
+        # Extraer cédulas de la pregunta (sin repetidas, en orden de aparición)
+        cedulas_en_pregunta = dict.fromkeys(CEDULA_RE.findall(prompt))
         
-        # Buscar imágenes asociadas a cédulas
+        # Buscar imágenes asociadas a cédulas y firmar cada blob una sola vez
+        blobs_imagenes = {}
         for cedula in cedulas_en_pregunta:
-            urls = encontrar_imagenes_por_cedula(cedula)
-            if urls:
-                urls_imagenes.extend([generar_url_sas(url) for url in urls])
+            blobs_imagenes.update(dict.fromkeys(encontrar_imagenes_por_cedula(cedula)))
+        urls_imagenes = [generar_url_sas(url) for url in blobs_imagenes]
         
-        # Construir contexto
-        contexto = prompt_base + st.session_state.documentos_contexto
+        # Construir contexto solo con los fragmentos relevantes
+        # La consulta incluye la pregunta anterior, para seguimientos como "¿y sus faltantes?"
+        listado = obtener_listado()
+        preguntas = [m["content"] for m in st.session_state.chat_history if m["role"] == "user"]
+        documentos = recuperar_fragmentos("\n".join(preguntas[-2:]), listado)
+        sistema = prompt_base
+        if documentos is None:
+            # Sin búsqueda por similitud, el contexto completo va en el mensaje de sistema,
+            # que así es idéntico en todos los turnos
+            sistema = prompt_base + obtener_contexto(listado)
+            documentos = ""
+
+        # Lo que cambia en cada turno va al final, justo antes de la pregunta, para que el
+        # prefijo (sistema + historial) se repita byte a byte y aproveche la caché de prompts
+        partes_turno = []
+        if documentos:
+            partes_turno.append("Fragmentos de documentos relevantes:\n" + documentos)
         if urls_imagenes:
-            contexto += "\n\nEnlaces de imágenes asociadas:\n" + "\n".join(urls_imagenes)
+            partes_turno.append("Enlaces de imágenes asociadas:\n" + "\n".join(urls_imagenes))
+        historial = historial_reciente(st.session_state.chat_history)
+        mensajes = [{"role": "system", "content": sistema}] + historial[:-1]
+        if partes_turno:
+            mensajes.append({"role": "system", "content": "\n\n".join(partes_turno)})
+        mensajes += historial[-1:]
         
-        # Consultar a OpenAI
+        # Consultar a OpenAI (la respuesta llega en streaming)
         try:
-            response = client.chat.completions.create(
+            stream = client.chat.completions.create(
                 model=AZURE_OPENAI_DEPLOYMENT,
-                messages=[
-                    {"role": "system", "content": contexto},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2
+                messages=mensajes,
+                temperature=0.2,
+                stream=True
             )
-            respuesta = response.choices[0].message.content
-            
-            # Mostrar respuesta
+        except Exception as e:
+            st.error(f"Error al consultar OpenAI: {e}")
+            stream = None
+
+    if stream is not None:
+        try:
+            # Mostrar respuesta a medida que se genera
             with st.chat_message("assistant"):
-                st.markdown(respuesta)
+                respuesta = st.write_stream(texto_respuesta(stream))
+                # Si el stream no trae texto (filtro de contenido, respuesta vacía) write_stream devuelve []
+                respuesta = respuesta if isinstance(respuesta, str) else ""
                 if urls_imagenes:
                     for img_url in urls_imagenes:
                         st.image(img_url, caption="Documento asociado", width=300)